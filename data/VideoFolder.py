@@ -1,49 +1,112 @@
-import collections
+import json
+import warnings
+import numpy as np
 import torch
 import torch.utils.data as data
 
 from random import shuffle as list_shuffle  # for shuffling list
 from math import ceil
-from os import listdir
-from os.path import isdir, join, isfile
-from itertools import islice
+from os import scandir, stat, cpu_count
+from os.path import join, isfile
 from numpy.core.multiarray import concatenate, ndarray
-from skvideo.io import FFmpegReader, ffprobe
+from skvideo.io import ffprobe
 from torch.utils.data.sampler import Sampler
-from torchvision import transforms as trn
 from tqdm import tqdm
-from time import sleep
-from bisect import bisect
+from collections import deque, namedtuple
+from collections.abc import Iterable, Iterator
+from torchcodec.decoders import VideoDecoder
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from threading import Lock
+from subprocess import Popen, PIPE, DEVNULL
+from weakref import finalize
+try:
+    from fcntl import fcntl, F_SETPIPE_SZ
+except ImportError:  # not on Linux
+    F_SETPIPE_SZ = None
 
 # Implement object from https://discuss.pytorch.org/t/loading-videos-from-folders-as-a-dataset-object/568
 
 VIDEO_EXTENSIONS = ['.mp4']  # pre-processing outputs MP4s only
+PROBE_CACHE = '.videofolder_cache.json'  # ffprobe results, saved in the data set root directory
+_ITER = (list, tuple)  # sample types, checked before the (slower) abstract Iterable
+_is_tensor = torch.is_tensor
 
 
 class BatchSampler(Sampler):
-    def __init__(self, data_source, batch_size):
+    def __init__(self, data_source, batch_size, big_t=1):
         """
         Samples batches sequentially, always in the same order.
+        Frames of a ``VideoFolder`` are sampled one resolution bucket after the other, so that a batch never mixes
+        frame sizes.
 
         :param data_source: data set to sample from
         :type data_source: Dataset
         :param batch_size: concurrent number of video streams
         :type batch_size: int
+        :param big_t: sequence length; buckets are padded to a multiple of it, so that no batch straddles two of them
+        :type big_t: int
+
+        Streams start evenly spread over their bucket and wrap around it when padded, so that no two streams read the
+        same frame at the same time step (unless a bucket has fewer frames than streams). Streams overlapping within a
+        padded bucket still yield distinct indices (equal modulo the data set length), so that they are told apart.
         """
         self.batch_size = batch_size
-        self.samples_per_row = ceil(len(data_source) / batch_size)
-        self.num_samples = self.samples_per_row * batch_size
+        self.frames = len(data_source)
+        spans = getattr(data_source, 'bucket_spans', [(0, self.frames)])
+        self.spans = [(start, stop, ceil(ceil((stop - start) / batch_size) / big_t) * big_t) for start, stop in spans]
+        self.num_samples = sum(samples_per_row for _, _, samples_per_row in self.spans) * batch_size
 
     def __iter__(self):
-        return (self.samples_per_row * i + j for j in range(self.samples_per_row) for i in range(self.batch_size))
+        for start, stop, samples_per_row in self.spans:
+            n = stop - start
+            offsets = [i * n // self.batch_size for i in range(self.batch_size)]  # distinct, if n >= batch_size
+            for j in range(samples_per_row):
+                for i, offset in enumerate(offsets):
+                    k = offset + j
+                    # wrap around within the bucket, past the data set end, on a lap of its own for every stream
+                    yield start + k % n + (k // n * self.batch_size + i) * self.frames
 
     def __len__(self):
         return self.num_samples  # fake nb of samples, transparent wrapping around
 
 
+class VideoBatch(namedtuple('VideoBatch', ('frames', 'targets'))):
+    """
+    Temporal batch of frames and targets, as returned by ``VideoCollate``
+
+    Have the ``DataLoader`` pin its memory, then move it with ``.to()``, so that the copy overlaps with computation,
+    and convert uint8 frames on device: ``frames = frames.to('cuda', non_blocking=True).float().mul_(1 / 255)``.
+    Batches decoded with ``VideoFolder(device='cuda')`` are already on the GPU and cannot be pinned
+    (``pin_memory=False``).
+    """
+    __slots__ = ()
+
+    def to(self, device, non_blocking=True):
+        """
+        Moves frames and targets to device
+
+        :param device: destination device
+        :type device: str
+        :param non_blocking: if ``True``, copies from pinned memory run asynchronously
+        :type non_blocking: bool
+        :return: batch on device
+        :rtype: VideoBatch
+        """
+        return VideoBatch(*(t.to(device, non_blocking=non_blocking) for t in self))
+
+
 class VideoCollate:
-    def __init__(self, batch_size):
+    def __init__(self, batch_size, data_source=None):
+        """
+        Collates samples into temporal batches
+
+        :param batch_size: concurrent number of video streams
+        :type batch_size: int
+        :param data_source: if given, batches are lists of frame indices, fetched at once with its ``get_batch()``
+        :type data_source: VideoFolder
+        """
         self.batch_size = batch_size
+        self.data_source = data_source
 
     def __call__(self, batch: iter) -> torch.Tensor or list(torch.Tensor):
         """
@@ -51,31 +114,128 @@ class VideoCollate:
 
         :param batch: samples from a Dataset object
         :type batch: list
-        :return: temporal batch of frames of size (t, batch_size, *frame.size()), 0 <= t < T, most likely t = T - 1
+        :return: temporal batch of frames of size (t, batch_size, *frame.size()), 0 <= t < T, most likely t = T - 1,
+            with the same data type of the frames
         :rtype: tuple
         """
-        if torch.is_tensor(batch[0]):
-            return torch.cat(tuple(t.unsqueeze(0) for t in batch), 0).view(-1, self.batch_size, *batch[0].size())
-        elif isinstance(batch[0], int):
-            return torch.LongTensor(batch).view(-1, self.batch_size)
-        elif isinstance(batch[0], collections.Iterable):
+        if self.data_source is not None:  # batch of frame indices
+            return VideoBatch(*(t.view(-1, self.batch_size, *t.size()[1:]) for t in self.data_source.get_batch(batch)))
+        sample = batch[0]
+        if isinstance(sample, _ITER) or not _is_tensor(sample) and isinstance(sample, Iterable):
             # if each batch element is not a tensor, then it should be a tuple
             # of tensors; in that case we collate each element in the tuple
             transposed = zip(*batch)
-            return tuple(self.__call__(samples) for samples in transposed)
+            collated = tuple(self.__call__(samples) for samples in transposed)
+            return VideoBatch(*collated) if len(collated) == 2 else collated  # (frames, targets) samples
+        elif type(sample) is int:
+            return torch.as_tensor(batch, dtype=torch.long).view(-1, self.batch_size)
+        elif _is_tensor(sample):
+            return torch.stack(batch, 0).view(-1, self.batch_size, *sample.size())
 
         raise TypeError(("batch must contain tensors, numbers, or lists; found {}"
-                         .format(type(batch[0]))))
+                         .format(type(sample))))
+
+
+class TorchCodecReader:
+    def __init__(self, path, seek=0, prefetch=16, device='cpu'):
+        """
+        Iterates over the frames of a video, decoding chunks of contiguous frames in process with TorchCodec
+
+        :param path: video file path
+        :type path: str
+        :param seek: index of the first frame to read
+        :type seek: int
+        :param prefetch: number of contiguous frames decoded at once
+        :type prefetch: int
+        :param device: ``'cpu'`` or ``'cuda'``, to decode with NVDEC (falls back to CPU for unsupported codecs)
+        :type device: str
+        """
+        self._decoder = _video_decoder(path, device)
+        self._frames = deque()  # decoded frames, not yet read
+        self._seek = seek  # next frame to decode
+        self._prefetch = prefetch
+        self._device = device
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> torch.ByteTensor:
+        if not self._frames:  # no decoded frames left, decode the next chunk of contiguous frames
+            stop = min(self._seek + self._prefetch, len(self._decoder))
+            if self._seek >= stop: raise StopIteration
+            chunk = self._decoder.get_frames_in_range(self._seek, stop).data  # (t, h, w, c)
+            self._frames.extend(chunk.to(self._device))  # no-op, unless decoded on CPU as a fallback
+            self._seek = stop
+        return self._frames.popleft()
+
+    def close(self):
+        self._frames.clear()
+
+
+class RawFFmpegReader:
+    def __init__(self, path, size, seek=0, pool_size=4):
+        """
+        Iterates over the frames of a video, piped as raw RGB by an ffmpeg subprocess
+
+        Frames are read straight into a pool of reusable buffers; a buffer goes back to the pool once the frame handed
+        out (and everything viewing it) has been garbage collected.
+
+        :param path: video file path
+        :type path: str
+        :param size: frame (height, width)
+        :type size: tuple
+        :param seek: index of the first frame to read
+        :type seek: int
+        :param pool_size: maximum number of buffers kept for reuse
+        :type pool_size: int
+        """
+        self.height, self.width = size
+        self._frame_bytes = self.height * self.width * 3
+        self._pool = deque(maxlen=pool_size)  # free buffers
+        trim = ['-vf', 'trim=start_frame={}'.format(seek)] if seek else []
+        command = ['ffmpeg', '-loglevel', 'error', '-i', path, *trim,
+                   '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-vsync', '0', '-']
+        self.proc = Popen(command, bufsize=0, stdout=PIPE, stderr=DEVNULL)  # unbuffered, frames go straight to buffers
+        if F_SETPIPE_SZ is not None:
+            try:
+                fcntl(self.proc.stdout.fileno(), F_SETPIPE_SZ, 1 << 20)  # 1 MB pipe, fewer wake-ups per frame
+            except OSError:  # above /proc/sys/fs/pipe-max-size
+                pass
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> torch.ByteTensor:
+        buffer = self._pool.pop() if self._pool else bytearray(self._frame_bytes)
+        view, read = memoryview(buffer), 0
+        while read < self._frame_bytes:  # unbuffered reads return whatever is in the pipe
+            n = self.proc.stdout.readinto(view[read:])
+            if not n:  # end of video
+                self.close()
+                raise StopIteration
+            read += n
+        frame = ndarray((self.height, self.width, 3), 'u1', buffer)  # views (and tensors) of frame keep it alive
+        finalize(frame, self._pool.append, buffer)  # recycle the buffer once frame is gone
+        return torch.from_numpy(frame)
+
+    def close(self):
+        self.proc.stdout.close()
+        self.proc.kill()
+        self.proc.wait()
 
 
 class VideoFolder(data.Dataset):
-    def __init__(self, root, transform=None, target_transform=None, video_index=False, shuffle=None):
+    def __init__(self, root, transform=None, target_transform=None, video_index=False, shuffle=None, prefetch=16,
+                 return_uint8=True, backend='torchcodec', device='cpu', verbose=False):
         """
         Initialise a ``data.Dataset`` object for concurrent frame fetching from videos in a directory of folders of videos
 
         :param root: Data directory (train or validation folders path)
         :type root: str
-        :param transform: image transform-ing object from ``torchvision.transforms``
+        :param transform: image transform-ing object from ``torchvision.transforms``; ``torch.nn.Module`` ones, such as
+            ``torch.nn.Sequential(v2.CenterCrop(224))``, get compiled with TorchScript when scriptable (``v2.Compose``
+            is not, and runs eagerly) and require ``return_uint8=True``. Frames are uint8, so normalisation is better
+            left to after the device transfer (``.float().div_(255)``, then ``Normalize``)
         :type transform: object
         :param target_transform: label transformation / mapping
         :type target_transform: object
@@ -83,39 +243,212 @@ class VideoFolder(data.Dataset):
         :type video_index: bool
         :param shuffle: ``None``, ``'init'`` or ``True``
         :type shuffle: str
+        :param prefetch: number of contiguous frames decoded at once for every opened video
+        :type prefetch: int
+        :param return_uint8: if ``True``, frames are ``uint8`` tensors of size (c, h, w) instead of (h, w, c) ndarrays;
+            convert them to float once on device, e.g. ``x = x.to(device, non_blocking=True).float().mul_(1 / 255)``
+        :type return_uint8: bool
+        :param backend: ``'torchcodec'`` (in process, chunked decoding) or ``'ffmpeg'`` (subprocess, pooled buffers)
+        :type backend: str
+        :param device: where frames are decoded, ``'cuda'`` hands out GPU tensors (``'torchcodec'`` backend and
+            ``return_uint8`` only); CUDA cannot be used by ``DataLoader`` workers and its tensors cannot be pinned, so
+            set ``num_workers=0`` and ``pin_memory=False``
+        :type device: str
+        :param verbose: if ``True``, shows the videos probing progress bar
+        :type verbose: bool
         """
+        if device != 'cpu' and (backend != 'torchcodec' or not return_uint8):
+            raise ValueError("decoding on {} requires backend='torchcodec' and return_uint8=True".format(device))
+        if isinstance(transform, torch.nn.Module) and not return_uint8:
+            raise ValueError('torch.nn.Module transforms require return_uint8=True, they take tensors, not arrays')
+
         classes, class_to_idx = self._find_classes(root)
         video_paths = self._find_videos(root, classes)
-        videos, frames, frames_per_video, frames_per_class = self._make_data_set(
-            root, video_paths, class_to_idx, shuffle, video_index
+        (first, last, paths, targets), frames_per_video, frames_per_class, buckets = self._make_data_set(
+            root, video_paths, class_to_idx, shuffle, video_index, verbose
         )
 
         self.root = root
         self.video_paths = video_paths
-        self.videos = videos
-        self.opened_videos = [[] for _ in videos]
-        self.frames = frames
+        self._first = first  # videos metadata, as parallel arrays
+        self._last = last
+        self._paths = paths
+        self._targets = targets
+        self._buckets = buckets  # (height, width) -> video indices, laid out contiguously
+        self.opened_videos = [dict() for _ in paths]  # next seek -> video readers (one per stream at that seek)
+        self._decoders = dict()  # video index -> decoder, for random access
+        self._locks = [Lock() for _ in paths]
+        self._pool, self._pool_size = None, 0  # threads fetching streams (or videos) in parallel, created on demand
+        self.frames = sum(frames_per_video)
         self.frames_per_video = frames_per_video
         self.frames_per_class = frames_per_class
         self.classes = classes
         self.class_to_idx = class_to_idx
         self.transform = transform
+        self._transform = self._script(transform)
         self.target_transform = target_transform
         self.alternative_target = video_index
         self.shuffle = shuffle
+        self.return_uint8 = return_uint8
+        self._prefetch = prefetch
+        self.backend = backend
+        self.device = device
 
     def __getitem__(self, frame_idx):
         if frame_idx == 0:
-            self.free()
-            if self.shuffle is True:
-                self._shuffle()
+            self._new_epoch()
+
+        return self._get_sample(frame_idx)
+
+    def __getitems__(self, frame_indices):
+        """
+        Fetches a whole batch of samples, decoding concurrent video streams in parallel
+
+        Consecutive frame indices belong to the same stream and have to be read in order, while different streams are
+        independent from each other; every stream is therefore fetched by its own thread.
+
+        :param frame_indices: frame indices, as yielded by ``BatchSampler``
+        :type frame_indices: list
+        :return: (frame, target) samples, in the same order of ``frame_indices``
+        :rtype: list
+        """
+        if 0 in frame_indices:
+            self._new_epoch()
+
+        streams = list()  # positions of every stream's frames within the batch
+        tails = dict()  # last frame index -> stream ending there, still to be continued
+        for position, frame_idx in enumerate(frame_indices):
+            stream = tails.pop(frame_idx - 1, None)  # continue the stream ending at the previous frame, if any
+            if stream is None:  # or start a new one (also if frame_idx is repeated, overwriting only its tail)
+                stream = list()
+                streams.append(stream)
+            stream.append(position)
+            tails[frame_idx] = stream
+
+        samples = [None] * len(frame_indices)
+
+        def fetch_stream(positions):
+            for p in positions:
+                samples[p] = self._get_sample(frame_indices[p])
+
+        if len(streams) == 1:  # single stream, don't bother spawning threads
+            fetch_stream(*streams)
+        else:
+            for _ in self._thread_pool(len(streams)).map(fetch_stream, streams): pass  # propagates exceptions
+
+        assert None not in samples, 'positions left unfetched by stream grouping'
+        return samples
+
+    def __len__(self):
+        return self.frames
+
+    def get_batch(self, frame_indices):
+        """
+        Fetches a whole batch at once: frames of a video are decoded with a single call, videos in parallel threads,
+        and the transform (which has to accept batches) is applied to the whole batch
+
+        Only available with ``backend='torchcodec'`` and ``return_uint8=True``.
+
+        :param frame_indices: frame indices, as yielded by ``BatchSampler``
+        :type frame_indices: list
+        :return: frames of size (n, c, h, w) and targets of size (n), in the same order of ``frame_indices``
+        :rtype: tuple
+        """
+        if self.backend != 'torchcodec' or not self.return_uint8:
+            raise ValueError("get_batch() requires backend='torchcodec' and return_uint8=True")
+
+        if 0 in frame_indices:
+            self._new_epoch()
+
+        frame_indices = np.asarray(frame_indices, dtype=np.int64) % self.frames  # wrap around indexing
+        video_indices = np.searchsorted(self._last, frame_indices)  # video to which every frame belongs
+        videos = np.unique(video_indices)
+        positions = [np.flatnonzero(video_indices == video_idx) for video_idx in videos]
+
+        def decode(video_idx, video_positions):
+            decoder = self._decoders.get(video_idx)
+            if decoder is None:
+                decoder = _video_decoder(join(self.root, self._paths[video_idx]), self.device)
+                self._decoders[video_idx] = decoder
+            seeks = frame_indices[video_positions] - self._first[video_idx]
+            frames = decoder.get_frames_at(seeks.tolist()).data.to(self.device)  # (k, h, w, c)
+            if self._last[video_idx] in frame_indices[video_positions]:  # video read till the end, release its decoder
+                del self._decoders[video_idx]
+            return frames
+
+        if len(videos) == 1:  # single video, don't bother spawning threads
+            chunks = [decode(videos.item(), positions[0])]
+        else:
+            chunks = list(self._thread_pool(len(videos)).map(decode, videos.tolist(), positions))
+        order = torch.from_numpy(np.argsort(np.concatenate(positions)))  # from per video to frame_indices order
+        frames = torch.cat(chunks)[order].permute(0, 3, 1, 2)
+        if self._transform is not None:  # image processing
+            frames = self._transform(frames)
+
+        if self.alternative_target: return frames, torch.from_numpy(video_indices)
+
+        targets = self._targets[video_indices]
+        if self.target_transform is not None:  # target processing
+            return frames, torch.as_tensor([self.target_transform(int(target)) for target in targets])
+
+        return frames, torch.from_numpy(targets)
+
+    @property
+    def bucket_spans(self):
+        """
+        Frame index ranges [start, stop), one per resolution bucket
+        """
+        return [(int(self._first[indices[0]]), int(self._last[indices[-1]]) + 1) for indices in self._buckets.values()]
+
+    @property
+    def videos(self):
+        """
+        Videos metadata, as a list of ((last frame, first frame), (path, target)) items
+        """
+        return [((int(last), int(first)), (path, int(target)))
+                for first, last, path, target in zip(self._first, self._last, self._paths, self._targets)]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['opened_videos'] = [dict() for _ in self._paths]  # readers are not picklable
+        state['_decoders'] = dict()  # neither are decoders
+        del state['_locks']  # neither are locks
+        del state['_transform']  # nor script modules
+        state['_pool'], state['_pool_size'] = None, 0  # nor threads, every worker spawns its own
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._locks = [Lock() for _ in self._paths]
+        self._transform = self._script(self.transform)
+
+    def _thread_pool(self, workers):
+        """
+        Returns the thread pool shared by all batches, (re)creating it if it has fewer than ``workers`` threads
+
+        :param workers: number of tasks to be run in parallel
+        :type workers: int
+        :return: thread pool
+        :rtype: ThreadPoolExecutor
+        """
+        if self._pool_size < workers:
+            if self._pool is not None: self._pool.shutdown(wait=False)  # pending tasks (if any) still complete
+            self._pool, self._pool_size = ThreadPoolExecutor(max_workers=workers), workers
+        return self._pool
 
+    def _new_epoch(self):
+        self.free()
+        if self.shuffle is True:
+            self._shuffle()
+
+    def _get_sample(self, frame_idx):
         frame_idx %= self.frames  # wrap around indexing, if asking too much
-        video_idx = bisect(self.videos, ((frame_idx,),))  # video to which frame_idx belongs
-        (last, first), (path, target) = self.videos[video_idx]  # get video metadata
+        video_idx = int(np.searchsorted(self._last, frame_idx))  # video to which frame_idx belongs
+        first, last = int(self._first[video_idx]), int(self._last[video_idx])  # get video metadata
+        target = int(self._targets[video_idx])
         frame = self._get_frame(frame_idx - first, video_idx, frame_idx == last)  # get frame from video
-        if self.transform is not None:  # image processing
-            frame = self.transform(frame)
+        if self._transform is not None:  # image processing
+            frame = self._transform(frame)
         if self.target_transform is not None:  # target processing
             target = self.target_transform(target)
 
@@ -123,113 +456,198 @@ class VideoFolder(data.Dataset):
 
         return frame, target
 
-    def __len__(self):
-        return self.frames
-
     def _get_frame(self, seek, video_idx, last):
 
-        opened_video = None  # handle to opened target video
-        if self.opened_videos[video_idx]:  # if handle(s) exists for target video
-            current = self.opened_videos[video_idx]  # get handles list
-            opened_video = next((ov for ov in current if ov[0] == seek), None)  # look for matching seek
+        with self._locks[video_idx]:  # readers of a video may be shared by concurrent streams
+            # take ownership of a reader (if any) matching seek, while reading from it
+            readers = self.opened_videos[video_idx].get(seek)
+            opened_video = readers.pop() if readers else None
+            if readers == []: del self.opened_videos[video_idx][seek]
 
-        if opened_video is None:  # no (matching) handle found
-            video_path = join(self.root, self.videos[video_idx][1][0])  # build video path
-            video_file = FFmpegReader(video_path)  # get a video file pointer
-            video_iter = video_file.nextFrame()  # get an iterator
-            opened_video = [seek, islice(video_iter, seek, None), video_file]  # seek video and create o.v. item
-            self.opened_videos[video_idx].append(opened_video)  # add opened video object to o.v. list
+        if opened_video is None:  # no (matching) reader found
+            opened_video = self._open(video_idx, seek)
 
-        opened_video[0] = seek + 1  # update seek pointer
-        frame = next(opened_video[1])  # cache output frame
+        frame = next(opened_video)  # uint8 tensor of size (h, w, c)
         if last:
-            opened_video[2]._close()  # close video file (private method?!)
-            self.opened_videos[video_idx].remove(opened_video)  # remove o.v. item
+            opened_video.close()  # close video file
+        else:
+            with self._locks[video_idx]:
+                # give the reader back, at next seek, next to other streams' readers sharing it (if any)
+                self.opened_videos[video_idx].setdefault(seek + 1, []).append(opened_video)
+
+        return frame.permute(2, 0, 1) if self.return_uint8 else frame.numpy()
 
-        return frame
+    def _open(self, video_idx, seek):
+        video_path = join(self.root, self._paths[video_idx])  # build video path
+        if self.backend == 'ffmpeg':
+            size = next(size for size, indices in self._buckets.items() if indices[0] <= video_idx <= indices[-1])
+            return RawFFmpegReader(video_path, size, seek)
+        return TorchCodecReader(video_path, seek, self._prefetch, self.device)
 
     def free(self):
         """
         Frees all video files' pointers
         """
         for video in self.opened_videos:  # for every opened video
-            for _ in range(len(video)):  # for as many times as pointers
-                opened_video = video.pop()  # pop an item
-                opened_video[2]._close()  # close the file
+            for readers in video.values():  # regardless of their seek
+                for opened_video in readers:
+                    opened_video.close()  # close the file
+            video.clear()
+        self._decoders.clear()
 
     def _shuffle(self):
         """
         Shuffles the video list
         by regenerating the sequence to sample sequentially
         """
-        def _is_video_file(filename_):
-            return any(filename_.endswith(extension) for extension in VIDEO_EXTENSIONS)
-
-        root = self.root
         video_paths = self.video_paths
-        class_to_idx = self.class_to_idx
+        size_of = {self._paths[i]: size for size, indices in self._buckets.items() for i in indices}
+        meta = {path: (frames, size_of[path]) for path, frames in zip(self._paths, self.frames_per_video)}
         list_shuffle(video_paths)  # shuffle
 
-        videos = list()
-        frames_per_video = list()
-        frames_counter = 0
-        for filename in tqdm(video_paths, ncols=80):
-            class_ = filename.split('/')[0]
-            data_path = join(root, filename)
-            if _is_video_file(data_path):
-                video_meta = ffprobe(data_path)
-                start_idx = frames_counter
-                frames = int(video_meta['video'].get('@nb_frames'))
-                frames_per_video.append(frames)
-                frames_counter += frames
-                item = ((frames_counter - 1, start_idx), (filename, class_to_idx[class_]))
-                videos.append(item)
-
-        sleep(0.5)  # allows for progress bar completion
         # update the attributes with the altered sequence
         self.video_paths = video_paths
-        self.videos = videos
-        self.frames = frames_counter
-        self.frames_per_video = frames_per_video
+        (self._first, self._last, self._paths, self._targets), self.frames_per_video, self._buckets = \
+            self._sequence_videos(video_paths, meta, self.class_to_idx)
+
+    @staticmethod
+    def _script(transform):
+        if isinstance(transform, torch.nn.Module):
+            try:
+                return torch.jit.script(transform)
+            except Exception:  # not scriptable (e.g. v2.Compose, v2.ToDtype or custom modules), run it eagerly
+                pass
+        return transform
 
     @staticmethod
     def _find_classes(data_path):
-        classes = [d for d in listdir(data_path) if isdir(join(data_path, d))]
-        classes.sort()
+        with scandir(data_path) as entries:  # directory entries cache their type, no extra stat per entry
+            classes = sorted(entry.name for entry in entries if entry.is_dir())
         class_to_idx = {classes[i]: i for i in range(len(classes))}
         return classes, class_to_idx
 
     @staticmethod
     def _find_videos(root, classes):
-        return [join(c, d) for c in classes for d in listdir(join(root, c))]
+        video_paths = list()
+        for c in classes:
+            with scandir(join(root, c)) as entries:
+                video_paths.extend(join(c, entry.name) for entry in entries
+                                   if entry.is_file() and entry.name.endswith(tuple(VIDEO_EXTENSIONS)))
+        return video_paths
+
+    @staticmethod
+    def _probe_videos(root, video_paths, verbose):
+        """
+        Gets the number of frames and size of every video, running ffprobe only for files not in the root's cache
+
+        :param root: data directory
+        :type root: str
+        :param video_paths: video paths, relative to root
+        :type video_paths: list
+        :param verbose: if ``True``, shows a progress bar
+        :type verbose: bool
+        :return: mapping from video path to its number of frames and (height, width)
+        :rtype: dict
+        """
+        cache_path = join(root, PROBE_CACHE)
+        try:
+            with open(cache_path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):  # no cache yet, or corrupted
+            cache = dict()
+
+        stats, to_probe = dict(), list()
+        for filename in video_paths:
+            file_stat = stat(join(root, filename))
+            stats[filename] = {'mtime': file_stat.st_mtime, 'size': file_stat.st_size}
+            cached = cache.get(filename)
+            if cached is None or 'height' not in cached or any(cached[k] != v for k, v in stats[filename].items()):
+                to_probe.append(filename)
+
+        if to_probe:
+            with ProcessPoolExecutor(max_workers=cpu_count()) as executor:
+                probed = executor.map(_probe_one, [join(root, f) for f in to_probe], chunksize=8)
+                if verbose: probed = tqdm(probed, total=len(to_probe), ncols=80)
+                for filename, (_, frames, (h, w)) in zip(to_probe, probed):
+                    cache[filename] = dict(stats[filename], frames=frames, height=h, width=w)
+            cache = {filename: cache[filename] for filename in stats}  # forget deleted files
+            try:
+                with open(cache_path, 'w') as f:
+                    json.dump(cache, f)
+            except OSError:  # read-only data set, we'll probe again next time
+                pass
+
+        return {f: (cache[f]['frames'], (cache[f]['height'], cache[f]['width'])) for f in stats}
 
     @staticmethod
-    def _make_data_set(root, video_paths, class_to_idx, init_shuffle, video_index):
-        def _is_video_file(filename_):
-            return any(filename_.endswith(extension) for extension in VIDEO_EXTENSIONS)
+    def _make_data_set(root, video_paths, class_to_idx, init_shuffle, video_index, verbose):
+        meta = VideoFolder._probe_videos(root, video_paths, verbose)
 
         if init_shuffle and not video_index:
             list_shuffle(video_paths)  # shuffle
 
-        videos = list()
-        frames_per_video = list()
-        frames_per_class = [0] * len(class_to_idx)
-        frames_counter = 0
-        for filename in tqdm(video_paths, ncols=80):
-            class_ = filename.split('/')[0]
-            data_path = join(root, filename)
-            if _is_video_file(data_path):
-                video_meta = ffprobe(data_path)
-                start_idx = frames_counter
-                frames = int(video_meta['video'].get('@nb_frames'))
-                frames_per_video.append(frames)
-                frames_per_class[class_to_idx[class_]] += frames
-                frames_counter += frames
-                item = ((frames_counter - 1, start_idx), (filename, class_to_idx[class_]))
-                videos.append(item)
-
-        sleep(0.5)  # allows for progress bar completion
-        return videos, frames_counter, frames_per_video, frames_per_class
+        (first, last, paths, targets), frames_per_video, buckets = VideoFolder._sequence_videos(
+            video_paths, meta, class_to_idx
+        )
+        frames_per_class = np.bincount(targets, weights=frames_per_video, minlength=len(class_to_idx))
+        return (first, last, paths, targets), frames_per_video, frames_per_class.astype(int).tolist(), buckets
+
+    @staticmethod
+    def _sequence_videos(video_paths, meta, class_to_idx):
+        """
+        Lays videos one after the other, grouped by size and otherwise in the video_paths order
+
+        :param video_paths: video paths, relative to root
+        :type video_paths: list
+        :param meta: mapping from video path to its number of frames and (height, width)
+        :type meta: dict
+        :param class_to_idx: mapping from class name to target
+        :type class_to_idx: dict
+        :return: (first frames, last frames, paths, targets) parallel arrays, frames per video and size buckets
+        :rtype: tuple
+        """
+        paths = sorted(video_paths, key=lambda f: meta[f][1])  # stable, keeps video_paths order within sizes
+        frames_per_video = [meta[filename][0] for filename in paths]
+        targets = np.fromiter((class_to_idx[filename.split('/')[0]] for filename in paths), np.int64, len(paths))
+        last = np.cumsum(frames_per_video, dtype=np.int64) - 1
+        first = last - np.array(frames_per_video, dtype=np.int64) + 1
+        buckets = dict()
+        for video_idx, filename in enumerate(paths):
+            buckets.setdefault(meta[filename][1], []).append(video_idx)
+        return (first, last, paths, targets), frames_per_video, buckets
+
+
+def _video_decoder(path, device='cpu'):
+    """
+    Opens a video with TorchCodec, falling back to CPU decoding (with a warning) if the device fails to open it
+
+    :param path: video file path
+    :type path: str
+    :param device: ``'cpu'`` or ``'cuda'``
+    :type device: str
+    :return: decoder returning frames of size (h, w, c)
+    :rtype: VideoDecoder
+    """
+    try:
+        return VideoDecoder(path, dimension_order='NHWC', num_ffmpeg_threads=2, device=device)
+    except RuntimeError as error:
+        if device == 'cpu': raise  # nothing to fall back to
+        # e.g. codec not supported by the device's decoder, but possibly a driver failure: don't hide it
+        warnings.warn('decoding {} on CPU, {} failed: {}'.format(path, device, error), RuntimeWarning)
+        return VideoDecoder(path, dimension_order='NHWC', num_ffmpeg_threads=2)
+
+
+def _probe_one(video_path):
+    """
+    Reads the number of frames and size of a video with ffprobe
+
+    :param video_path: video file path
+    :type video_path: str
+    :return: video path, its number of frames and (height, width)
+    :rtype: tuple
+    """
+    video_meta = ffprobe(video_path)['video']
+    return video_path, int(video_meta.get('@nb_frames')), (int(video_meta['@height']), int(video_meta['@width']))
 
 
 def _test_video_folder():
@@ -237,7 +655,7 @@ def _test_video_folder():
 
     batch_size = 5
 
-    video_data_set = VideoFolder('small_data_set/')
+    video_data_set = VideoFolder('small_data_set/', return_uint8=False, verbose=True)
     nb_of_classes = len(video_data_set.classes)
     print('There are', nb_of_classes, 'classes')
     print(indent(fill(' '.join(video_data_set.classes), 77), '   '))
@@ -282,19 +700,42 @@ def _test_video_folder():
 def _test_data_loader():
     big_t = 10
     batch_size = 5
-    t = trn.Compose((trn.ToPILImage(), trn.ToTensor()))  # <-- add trn.CenterCrop(224) in between for training
-    data_set = VideoFolder('small_data_set', t)
+    data_set = VideoFolder('small_data_set')  # uint8 frames, 4 times cheaper to move around than float ones
+    # a single persistent worker keeps its decoders open across batches and epochs (streams are fetched by threads);
+    # more workers would be dealt alternate batches, breaking the sequential reading of every stream
     my_loader = data.DataLoader(dataset=data_set, batch_size=batch_size * big_t, shuffle=False,
-                                sampler=BatchSampler(data_set, batch_size), num_workers=0,
-                                collate_fn=VideoCollate(batch_size))
-    print('Is my_loader an iterator [has __next__()]:', isinstance(my_loader, collections.Iterator))
-    print('Is my_loader an iterable [has __iter__()]:', isinstance(my_loader, collections.Iterable))
+                                sampler=BatchSampler(data_set, batch_size, big_t), num_workers=1,
+                                collate_fn=VideoCollate(batch_size), pin_memory=True,
+                                persistent_workers=True, prefetch_factor=4)
+    print('Is my_loader an iterator [has __next__()]:', isinstance(my_loader, Iterator))
+    print('Is my_loader an iterable [has __iter__()]:', isinstance(my_loader, Iterable))
     my_iter = iter(my_loader)
     my_batch = next(my_iter)
     print('my_batch is a', type(my_batch), 'of length', len(my_batch))
     print('my_batch[0] is a', my_batch[0].type(), 'of size', tuple(my_batch[0].size()), '  # will 224, 224')
-    _show_torch(_tile_up(my_batch), .2)
-    for i in range(3): _show_torch(_tile_up(next(my_iter)), .2)
+    _show_torch(_tile_up(_to_float(my_batch)), .2)
+    for i in range(3): _show_torch(_tile_up(_to_float(next(my_iter))), .2)
+
+
+def _test_batch_loader():
+    big_t = 10
+    batch_size = 5
+    data_set = VideoFolder('small_data_set')
+    # lists of frame indices, every one fetched at once by the collate function through data_set.get_batch()
+    batches = list(data.BatchSampler(BatchSampler(data_set, batch_size, big_t), batch_size * big_t, drop_last=False))
+    my_loader = data.DataLoader(dataset=batches, batch_size=None, num_workers=1,
+                                collate_fn=VideoCollate(batch_size, data_set), pin_memory=True,
+                                persistent_workers=True, prefetch_factor=4)
+    my_iter = iter(my_loader)
+    my_batch = next(my_iter)
+    print('my_batch[0] is a', my_batch[0].type(), 'of size', tuple(my_batch[0].size()))
+    _show_torch(_tile_up(_to_float(my_batch)), .2)
+    for i in range(3): _show_torch(_tile_up(_to_float(next(my_iter))), .2)
+
+
+def _to_float(batch):
+    x, y = batch  # on a training loop, batch.to('cuda') first
+    return x.float().div_(255), y
 
 
 def _show_numpy(tensor: ndarray, zoom: float = 1.) -> None:
@@ -312,19 +753,19 @@ def _show_numpy(tensor: ndarray, zoom: float = 1.) -> None:
 
 
 def _show_torch(tensor: torch.FloatTensor, zoom: float = 1.) -> None:
-    numpy_tensor = tensor.clone().mul(255).int().numpy().astype('u1').transpose(1, 2, 0)
+    numpy_tensor = tensor.mul(255).clamp_(0, 255).to(torch.uint8).numpy().transpose(1, 2, 0)
     _show_numpy(numpy_tensor, zoom)
 
 
 def _tile_up(temporal_batch):
-    a = torch.cat(tuple(temporal_batch[0][:, i] for i in range(temporal_batch[0].size(1))), 2)
-    a = torch.cat(tuple(a[j] for j in range(a.size(0))), 2)
-    return a
+    t, b, c, h, w = temporal_batch[0].size()
+    return temporal_batch[0].permute(2, 1, 3, 0, 4).reshape(c, b * h, t * w)  # streams down, time across
 
 
 if __name__ == '__main__':
     _test_video_folder()
     _test_data_loader()
+    _test_batch_loader()
 
 
 __author__ = "Alfredo Canziani"
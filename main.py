@@ -10,7 +10,7 @@ import torch.nn as nn
 import torch.optim as optim
 from torch.autograd import Variable as V
 from torch.utils.data import DataLoader
-from torchvision import transforms as trn
+from torchvision.transforms import v2
 
 from data.VideoFolder import VideoFolder, BatchSampler, VideoCollate
 from utils.image_plot import show_four, show_ten
@@ -68,7 +68,7 @@ def main():
     # Load data
     print('Define image pre-processing')
     # normalise? do we care?
-    t = trn.Compose((trn.ToPILImage(), trn.CenterCrop(args.spatial_size), trn.ToTensor()))
+    t = v2.CenterCrop(args.spatial_size)  # crops uint8 frames, no PIL round trip, compiled by VideoFolder
 
     print('Define train data loader')
     train_data_name = 'train_data.tar'
@@ -77,19 +77,21 @@ def main():
     else:
         train_path = path.join(args.data, 'train')
         if args.mode == 'MatchNet':
-            train_data = VideoFolder(root=train_path, transform=t, video_index=True)
+            train_data = VideoFolder(root=train_path, transform=t, video_index=True, verbose=True)
         elif args.mode == 'TempoNet':
-            train_data = VideoFolder(root=train_path, transform=t, shuffle=True)
+            train_data = VideoFolder(root=train_path, transform=t, shuffle=True, verbose=True)
         torch.save(train_data, train_data_name)
 
     train_loader = DataLoader(
         dataset=train_data,
         batch_size=args.batch_size * args.big_t,  # batch_size rows and T columns
         shuffle=False,
-        sampler=BatchSampler(data_source=train_data, batch_size=args.batch_size),  # given that BatchSampler knows it
+        sampler=BatchSampler(data_source=train_data, batch_size=args.batch_size, big_t=args.big_t),
         num_workers=1,
         collate_fn=VideoCollate(batch_size=args.batch_size),
-        pin_memory=True
+        pin_memory=True,
+        persistent_workers=True,  # keep opened videos across epochs
+        prefetch_factor=4
     )
 
     print('Define validation data loader')
@@ -99,9 +101,9 @@ def main():
     else:
         val_path = path.join(args.data, 'val')
         if args.mode == 'MatchNet':
-            val_data = VideoFolder(root=val_path, transform=t, video_index=True)
+            val_data = VideoFolder(root=val_path, transform=t, video_index=True, verbose=True)
         elif args.mode == 'TempoNet':
-            val_data = VideoFolder(root=val_path, transform=t, shuffle='init')
+            val_data = VideoFolder(root=val_path, transform=t, shuffle='init', verbose=True)
         torch.save(val_data, val_data_name)
 
     val_loader = DataLoader(
@@ -111,7 +113,9 @@ def main():
         sampler=BatchSampler(data_source=val_data, batch_size=args.batch_size),
         num_workers=1,
         collate_fn=VideoCollate(batch_size=args.batch_size),
-        pin_memory=True
+        pin_memory=True,
+        persistent_workers=True,  # keep opened videos across epochs
+        prefetch_factor=4
     )
 
     # Build the model
@@ -282,8 +286,9 @@ def train(train_loader, model, loss_fun, optimiser, epoch):
     for batch_nb, (x, y) in enumerate(train_loader):
         data_time += time.time() - end_time
         if args.cuda:
-            x = x.cuda(async=True)
-            y = y.cuda(async=True)
+            x = x.cuda(non_blocking=True)
+            y = y.cuda(non_blocking=True)
+        x = x.float().div_(255)  # uint8 -> float, on device
         state = repackage_state(state)
         loss = 0
         # BTT loop
@@ -351,14 +356,16 @@ def validate(val_loader, model, loss_fun):
 
     _, (x, y) = next(batches)
     if args.cuda:
-        x = x.cuda(async=True)
-        y = y.cuda(async=True)
+        x = x.cuda(non_blocking=True)
+        y = y.cuda(non_blocking=True)
+    x = x.float().div_(255)  # uint8 -> float, on device
     previous_mismatch = y[0].byte().fill_(1)  # ignore first prediction
     state = None  # reset state at the beginning of a new epoch
     for batch_nb, (next_x, next_y) in batches:
         if args.cuda:
-            next_x = next_x.cuda(async=True)
-            next_y = next_y.cuda(async=True)
+            next_x = next_x.cuda(non_blocking=True)
+            next_y = next_y.cuda(non_blocking=True)
+        next_x = next_x.float().div_(255)  # uint8 -> float, on device
         mismatch = next_y[0] != y[0]
         (x_hat, state), (_, idx) = model(V(x[0], volatile=True), state)  # do not compute graph (volatile)
         selective_zero(state, mismatch)  # no state to the future